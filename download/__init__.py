@@ -1,4 +1,4 @@
 """A tiny module to make downloading with python super easy."""
-from .download import download
+from .download import download, download_many, download_many_async, get_session
 
 __version__ = "0.3.6dev0"
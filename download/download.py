@@ -1,18 +1,23 @@
 """Utilities to download a file. Heavily copied from MNE-python."""
 import os
 import os.path as op
-from subprocess import check_output
 from six.moves import urllib
-from zipfile import ZipFile
-import tarfile
-import logging
-from math import log, ceil
-import time
 import sys
 import shutil
 import tempfile
-import ftplib
-from functools import partial
+import hashlib
+import io
+import json
+import mmap
+import re
+import http.client
+import select
+import socket
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from functools import lru_cache, partial
 from tqdm import tqdm
 
 if sys.version_info[0] == 3:
@@ -20,14 +25,58 @@ if sys.version_info[0] == 3:
 else:
     string_types = basestring
 
-ALLOWED_KINDS = ["file", "tar", "zip", "tar.gz"]
-ZIP_KINDS = ["tar", "zip", "tar.gz"]
+ALLOWED_KINDS = ["file", "tar", "zip", "tar.gz", "tar.bz2", "tar.xz"]
+ZIP_KINDS = ["tar", "zip", "tar.gz", "tar.bz2", "tar.xz"]
+
+# Streaming tarfile modes, which decompress the archive as it is read
+TAR_MODES = {"tar": "r|*", "tar.gz": "r|gz", "tar.bz2": "r|bz2", "tar.xz": "r|xz"}
 
 remote_file_size_default = 1
 
+SIZE_UNITS = ("bytes", "kB", "MB", "GB", "TB", "PB")
+SIZE_DECIMALS = (0, 0, 1, 2, 2, 2)
+
+# Buffer size used when streaming downloads to disk
+CHUNK_SIZE = 262144  # 2 ** 18
+
+# Buffer size for plain copies, with no per-chunk progress or hash updates
+COPY_SIZE = 1048576  # 2 ** 20
+
+# Zip archives up to this size are kept in memory before extraction
+ZIP_SPOOL_SIZE = 67108864  # 2 ** 26
+
+# Files smaller than this are not worth splitting into range requests
+RANGES_MIN_SIZE = 16777216  # 2 ** 24
+
+# Simulate a user-agent because some websites require it for this to work
+USER_AGENT = (
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_3) AppleWebKit/537.36 "
+    "(KHTML, like Gecko) Chrome/35.0.1916.47 Safari/537.36"
+)
+
+# Share links that need to be rewritten to point at the file itself
+_HOST_RE = re.compile(
+    r"^[a-z+]+://(?:[\w-]+\.)*(drive\.google\.com|dropbox\.com|github\.com)/",
+    re.IGNORECASE,
+)
+_GDRIVE_ID_RE = re.compile(r"/d/([^/?#]+)")
+_DROPBOX_DL_RE = re.compile(r"dl=0")
+_GITHUB_BLOB_RE = re.compile(r"^[^/]+//[^/]+/[^/]+/[^/]+/blob/")
+
+_session = None
+_session_lock = threading.Lock()
+
 
 def download(
-    url, path, kind="file", progressbar=True, replace=False, timeout=10.0, verbose=True
+    url,
+    path,
+    kind="file",
+    progressbar=True,
+    replace=False,
+    timeout=10.0,
+    verbose=True,
+    num_connections=1,
+    if_newer=False,
 ):
     """Download a URL.
 
@@ -46,7 +95,7 @@ def download(
     path : string
         The path where the downloaded file will be stored. If ``zipfile``
         is True, then this must be a folder into which files will be zipped.
-    kind : one of ['file', 'zip', 'tar', 'tar.gz']
+    kind : one of ['file', 'zip', 'tar', 'tar.gz', 'tar.bz2', 'tar.xz']
         The kind of file to be downloaded. If not 'file', then the file
         contents will be unpackaged according to the kind specified. Package
         contents will be placed in ``root_destination/<name>``.
@@ -59,6 +108,18 @@ def download(
         The URL open timeout.
     verbose : bool
         Whether to print download status to the screen.
+    num_connections : int
+        The number of parallel connections used to download the file over
+        http(s). If greater than 1 and the server supports range requests,
+        files of at least 16 MiB are split into this many parts that are
+        fetched concurrently.
+        Archives are always streamed over a single connection.
+    if_newer : bool
+        If True, ``replace`` is True and the URL points to a single file that
+        was already downloaded, only download it again if the server reports
+        that it changed since. This relies on the ``ETag`` and
+        ``Last-Modified`` headers, which are saved next to the file in
+        ``<path>.meta``.
 
     Returns
     -------
@@ -75,8 +136,7 @@ def download(
     if len(path) == 0:
         raise ValueError("You must specify a path. For current directory use .")
 
-    download_url = _convert_url_to_downloadable(url)
-
+    # Checked first, so existing data costs a single stat
     if replace is False and op.exists(path):
         msg = (
             "Replace is False and data exists, so doing nothing. "
@@ -84,67 +144,191 @@ def download(
         )
     elif kind in ZIP_KINDS:
         # Create new folder for data if we need it
-        if path and not op.isdir(path):
-            if verbose:
-                tqdm.write("Creating data folder...", file=sys.stdout)
-            os.makedirs(path)
-
-        # Download the file to a temporary folder to unzip
-        path_temp = _TempDir()
-        path_temp_file = op.join(path_temp, "tmp.{}".format(kind))
-        _fetch_file(
-            download_url,
-            path_temp_file,
+        os.makedirs(path, exist_ok=True)
+
+        # Unzip the file to the out path as it is downloaded
+        _stream_extract(
+            _convert_url_to_downloadable(url),
+            path,
+            kind,
             timeout=timeout,
             verbose=verbose,
             progressbar=progressbar,
         )
-
-        # Unzip the file to the out path
-        if verbose:
-            tqdm.write("Extracting {} file...".format(kind), file=sys.stdout)
-        if kind == "zip":
-            zipper = ZipFile
-        elif kind == "tar":
-            zipper = tarfile.open
-        elif kind == "tar.gz":
-            zipper = partial(tarfile.open, mode="r:gz")
-        with zipper(path_temp_file) as myobj:
-            myobj.extractall(path)
         msg = "Successfully downloaded / unzipped to {}".format(path)
     else:
-        directory = op.dirname(path)
-        if directory and not op.isdir(directory):
-            os.makedirs(directory)
-        _fetch_file(
-            download_url,
+        os.makedirs(op.dirname(path) or ".", exist_ok=True)
+        downloaded = _fetch_file(
+            _convert_url_to_downloadable(url),
             path,
             timeout=timeout,
             verbose=verbose,
             progressbar=progressbar,
+            num_connections=num_connections,
+            if_newer=if_newer,
         )
-        msg = "Successfully downloaded file to {}".format(path)
+        if downloaded:
+            msg = "Successfully downloaded file to {}".format(path)
+        else:
+            msg = "Remote file is unchanged, keeping {}".format(path)
     if verbose:
         tqdm.write(msg, file=sys.stdout)
     return path
 
 
+def download_many(pairs, max_workers=8, progressbar=True):
+    """Download several URLs concurrently.
+
+    Parameters
+    ----------
+    pairs : iterable of tuple
+        Each item is ``(url, path)`` or ``(url, path, kwargs)``, where
+        ``kwargs`` is a dictionary of extra arguments passed to
+        :func:`download` for that url.
+    max_workers : int
+        The maximum number of downloads to run at the same time.
+    progressbar : bool
+        Whether to display a progress bar counting finished downloads.
+        Individual downloads are quiet unless their ``kwargs`` say otherwise.
+
+    Returns
+    -------
+    out_paths : list of string
+        The paths returned by :func:`download`, in the order of ``pairs``.
+    """
+    jobs = _download_jobs(pairs)
+    with tqdm(
+            total=len(jobs),
+            desc="files",
+            ncols=80,
+            unit="file",
+            file=sys.stdout,
+            disable=not progressbar
+        ) as progress:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [
+                executor.submit(download, url, path, **kwargs)
+                for url, path, kwargs in jobs
+            ]
+            for future in as_completed(futures):
+                progress.update(1)
+            return [future.result() for future in futures]
+
+
+async def download_many_async(pairs, max_workers=8, progressbar=True):
+    """Download several URLs concurrently from a running event loop.
+
+    This is the awaitable version of :func:`download_many`. The downloads
+    run in a pool of threads, so the event loop is not blocked while they
+    are in progress.
+
+    Parameters
+    ----------
+    pairs : iterable of tuple
+        Each item is ``(url, path)`` or ``(url, path, kwargs)``, where
+        ``kwargs`` is a dictionary of extra arguments passed to
+        :func:`download` for that url.
+    max_workers : int
+        The maximum number of downloads to run at the same time.
+    progressbar : bool
+        Whether to display a progress bar counting finished downloads.
+        Individual downloads are quiet unless their ``kwargs`` say otherwise.
+
+    Returns
+    -------
+    out_paths : list of string
+        The paths returned by :func:`download`, in the order of ``pairs``.
+    """
+    import asyncio
+
+    jobs = _download_jobs(pairs)
+    loop = asyncio.get_running_loop()
+    with tqdm(
+            total=len(jobs),
+            desc="files",
+            ncols=80,
+            unit="file",
+            file=sys.stdout,
+            disable=not progressbar
+        ) as progress:
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+
+        async def run(url, path, kwargs):
+            try:
+                return await loop.run_in_executor(
+                    executor, partial(download, url, path, **kwargs)
+                )
+            finally:
+                progress.update(1)
+
+        try:
+            # Wait for every download before raising, like download_many
+            results = await asyncio.gather(
+                *(run(*job) for job in jobs), return_exceptions=True
+            )
+        finally:
+            # Do not block the event loop if the task gets cancelled while
+            # downloads are still running in the threads
+            executor.shutdown(wait=False)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    return results
+
+
+def _download_jobs(pairs):
+    """Normalize the ``pairs`` given to download_many."""
+    jobs = []
+    for pair in pairs:
+        url, path = pair[:2]
+        kwargs = dict(progressbar=False, verbose=False)
+        if len(pair) > 2:
+            kwargs.update(pair[2])
+        jobs.append((url, path, kwargs))
+    return jobs
+
+
+@lru_cache(maxsize=1024)
 def _convert_url_to_downloadable(url):
     """Convert a url to the proper style depending on its website."""
+    match = _HOST_RE.match(url)
+    if match is None:
+        return url
+    return _URL_CONVERTERS[match.group(1).lower()](url)
 
-    if "drive.google.com" in url:
-        # For future support of google drive
-        file_id = url.split("d/")[1].split("/")[0]
-        base_url = "https://drive.google.com/uc?export=download&id="
-        out = "{}{}".format(base_url, file_id)
-    elif "dropbox.com" in url:
-        if url.endswith(".png"):
-            out = url + "?dl=1"
-        else:
-            out = url.replace("dl=0", "dl=1")
-    else:
-        out = url
-    return out
+
+def _convert_gdrive_url(url):
+    # For future support of google drive
+    match = _GDRIVE_ID_RE.search(url)
+    if match is None:
+        raise ValueError("Could not find a file id in Google Drive url %s" % url)
+    base_url = "https://drive.google.com/uc?export=download&id="
+    return "{}{}".format(base_url, match.group(1))
+
+
+def _convert_dropbox_url(url):
+    if url.endswith(".png"):
+        return url + "?dl=1"
+    return _DROPBOX_DL_RE.sub("dl=1", url)
+
+
+def _convert_github_url(url):
+    # github.com redirects ?raw=true to the file itself, including files
+    # stored with Git LFS, which raw.githubusercontent.com only has pointers to
+    if _GITHUB_BLOB_RE.match(url) is None:
+        return url
+    parts = urllib.parse.urlsplit(url)
+    if "raw=true" in parts.query.split("&"):
+        return url
+    query = parts.query + "&raw=true" if parts.query else "raw=true"
+    return urllib.parse.urlunsplit(parts._replace(query=query))
+
+
+_URL_CONVERTERS = {
+    "drive.google.com": _convert_gdrive_url,
+    "dropbox.com": _convert_dropbox_url,
+    "github.com": _convert_github_url,
+}
 
 
 def _fetch_file(
@@ -155,6 +339,9 @@ def _fetch_file(
     timeout=10.0,
     progressbar=True,
     verbose=True,
+    num_connections=1,
+    if_newer=False,
+    algo="md5",
 ):
     """Load requested file, downloading it if needed or requested.
 
@@ -165,86 +352,180 @@ def _fetch_file(
     file_name: string
         Name, along with the path, of where downloaded file will be saved.
     resume: bool, optional
-        If true, try to resume partially downloaded files.
+        If true, try to resume partially downloaded files. A partial file is
+        only resumed if the remote file is unchanged since it was started,
+        as recorded in ``file_name + ".part.json"``.
     hash_ : str | None
-        The hash of the file to check. If None, no checking is
-        performed.
+        The hex digest of the file to check, computed with ``algo``. If None,
+        no checking is performed.
     timeout : float
         The URL open timeout.
     verbose : bool
         Whether to print download status.
+    num_connections : int
+        The number of parallel connections to use for http(s) downloads.
+    if_newer : bool
+        If True and ``file_name`` exists, send the validators saved in
+        ``file_name + ".meta"`` and skip the download if the server answers
+        that the file was not modified. The validators of the new file are
+        saved after a successful http(s) download.
+    algo : str
+        The name of the hashlib algorithm ``hash_`` was computed with, e.g.
+        ``"sha256"``, which is usually faster than md5 on recent CPUs.
+
+    Returns
+    -------
+    downloaded : bool
+        False if the download was skipped because the file was up to date.
     """
     # Adapted from NISL and MNE-python:
     # https://github.com/nisl/tutorial/blob/master/nisl/datasets.py
     # https://martinos.org/mne
-    if hash_ is not None and (not isinstance(hash_, string_types) or len(hash_) != 32):
-        raise ValueError(
-            "Bad hash value given, should be a 32-character " "string:\n%s" % (hash_,)
-        )
+    if hash_ is not None:
+        n_chars = hashlib.new(algo).digest_size * 2
+        if not isinstance(hash_, string_types) or len(hash_) != n_chars:
+            raise ValueError(
+                "Bad hash value given, should be a %d-character "
+                "string:\n%s" % (n_chars, hash_)
+            )
     temp_file_name = file_name + ".part"
+    part_meta_file_name = temp_file_name + ".json"
+    meta_file_name = file_name + ".meta"
+    source_url = url
 
     try:
         remote_file_size = remote_file_size_default
-        if "dropbox.com" in url:
-            # Use requests to handle cookies.
-            # XXX In the future, we should probably use requests everywhere.
-            # Unless we want to minimize dependencies.
+        scheme = urllib.parse.urlparse(url).scheme
+        response = None
+        # First byte requested from the server, if a range was asked for
+        range_start = None
+        # A single stat tells both whether there is a partial file and its size
+        partial_size = 0
+        if resume:
             try:
-                import requests
-            except ModuleNotFoundError:
-                raise ValueError(
-                    "To download Dropbox links, you need to "
-                    "install the `requests` module."
+                partial_size = os.stat(temp_file_name).st_size
+            except FileNotFoundError:
+                resume = False
+        if scheme in ("http", "https"):
+            headers = {}
+            if if_newer and op.isfile(file_name):
+                headers = _conditional_headers(_read_meta(meta_file_name), url)
+            if partial_size > 0:
+                # Ask for the rest of a partial download straight away
+                headers.update(
+                    _range_headers(_read_meta(part_meta_file_name), url, partial_size)
                 )
-            resp = requests.get(url, stream=True)
-            chunk_size = 8192  # 2 ** 13
-            with open(temp_file_name, "wb") as ff:
-                for chunk in resp.iter_content(chunk_size=chunk_size):
-                    if chunk:  # filter out keep-alive new chunks
-                        ff.write(chunk)
+            if "Range" in headers:
+                range_start = partial_size
+            elif num_connections > 1:
+                # The whole file, but a 206 reply tells that the server
+                # accepts the ranges needed to fetch it in parallel
+                headers["Range"] = "bytes=0-"
+                range_start = 0
+            elif not _is_gzip_file(url) and not _is_gzip_file(file_name):
+                # Let servers compress text files. Ranges refer to the
+                # uncompressed file, so they are always requested as is.
+                # Servers often mark .gz files as gzip encoded, which must
+                # not be undone, so those are not offered compression.
+                headers["Accept-Encoding"] = "gzip, deflate"
+            # A single GET follows any redirects, gives the file size and its
+            # body is then used for the download
+            try:
+                u = response = _open_url(url, timeout=timeout, headers=headers)
+            except Exception as err:
+                if "Range" not in headers or not _is_http_error(err):
+                    raise
+                # Some servers reject ranges they cannot serve (416 for an
+                # empty file, ...), so ask for the entire file instead
+                if verbose and range_start:
+                    tqdm.write(
+                        "Resuming download failed (server "
+                        "rejected the request). Restarting "
+                        "downloading the entire file.",
+                        file=sys.stdout,
+                    )
+                headers.pop("Range")
+                headers.pop("If-Range", None)
+                range_start = None
+                resume = False
+                u = response = _open_url(url, timeout=timeout, headers=headers)
+            if u.status == 304:
+                u.close()
+                return False
+            if "Accept-Encoding" in headers:
+                response.decode()
+            url = u.url
         else:
-            # Check file size and displaying it alongside the download url
-            req = request_agent(url)
-            u = urllib.request.urlopen(req, timeout=timeout)
+            # Check file size and follow any redirects
+            u = urllib.request.urlopen(request_agent(url), timeout=timeout)
             u.close()
-            # this is necessary to follow any redirects
             url = u.geturl()
-            req = request_agent(url)
-            u = urllib.request.urlopen(req, timeout=timeout)
-            try:
-                remote_file_size = int(
-                    u.headers.get(
-                        "Content-Length", str(remote_file_size_default)
-                    ).strip()
-                )
-            finally:
-                u.close()
-                del u
+        if response is not None and response.status == 206:
+            remote_file_size = _content_range_total(u.headers)
+        else:
+            remote_file_size = _content_length(u)
+        if verbose:
+            tqdm.write(
+                "Downloading data from %s (%s)\n"
+                % (url, _size_description(remote_file_size)),
+                file=sys.stdout,
+            )
+
+        # Triage resume
+        if resume and (
+            (
+                response is not None
+                and (response.status != 206 or range_start != partial_size)
+            )
+            or partial_size >= remote_file_size
+            or not _can_resume(
+                _read_meta(part_meta_file_name),
+                source_url,
+                u.headers,
+                remote_file_size,
+            )
+        ):
             if verbose:
                 tqdm.write(
-                    "Downloading data from %s (%s)\n"
-                    % (url, sizeof_fmt(remote_file_size)),
+                    "Remote file changed since the partial download started, "
+                    "or cannot be resumed. Restarting the download.",
                     file=sys.stdout,
                 )
+            resume = False
+        if (
+            response is not None
+            and response.status == 206
+            and range_start != 0
+            and not resume
+        ):
+            # Only part of the file was requested, ask for all of it instead
+            response.close()
+            response = None
+        if resume:
+            initial_size = partial_size
+        else:
+            initial_size = 0
+            _write_part_meta(
+                part_meta_file_name, source_url, url, u.headers, remote_file_size
+            )
+        # This should never happen if our functions work properly
+        if initial_size > remote_file_size:
+            raise RuntimeError(
+                "Local file (%s) is larger than remote "
+                "file (%s), cannot resume download"
+                % (sizeof_fmt(initial_size), sizeof_fmt(remote_file_size))
+            )
 
-            # Triage resume
-            if not os.path.exists(temp_file_name):
-                resume = False
-            if resume:
-                initial_size = op.getsize(temp_file_name)
+        # Hash the data as it is downloaded, rather than re-reading it after
+        hasher = None
+        if hash_ is not None:
+            if initial_size > 0:
+                hasher = _hash_file(temp_file_name, algo)
             else:
-                initial_size = 0
-            # This should never happen if our functions work properly
-            if initial_size > remote_file_size:
-                raise RuntimeError(
-                    "Local file (%s) is larger than remote "
-                    "file (%s), cannot resume download"
-                    % (sizeof_fmt(initial_size), sizeof_fmt(remote_file_size))
-                )
+                hasher = hashlib.new(algo)
 
-            scheme = urllib.parse.urlparse(url).scheme
-            fun = _get_http if scheme in ("http", "https") else _get_ftp
-            fun(
+        if scheme in ("http", "https"):
+            hasher = _get_http(
                 url,
                 temp_file_name,
                 initial_size,
@@ -252,18 +533,35 @@ def _fetch_file(
                 verbose,
                 progressbar,
                 ncols=80,
+                timeout=timeout,
+                num_connections=num_connections,
+                hasher=hasher,
+                response=response,
+            )
+        else:
+            hasher = _get_ftp(
+                url,
+                temp_file_name,
+                initial_size,
+                remote_file_size,
+                verbose,
+                progressbar,
+                ncols=80,
+                hasher=hasher,
             )
 
-            # check md5sum
-            if hash_ is not None:
-                if verbose:
-                    tqdm.write("Verifying download hash.", file=sys.stdout)
-                md5 = md5sum(temp_file_name)
-                if hash_ != md5:
-                    raise RuntimeError(
-                        "Hash mismatch for downloaded file %s, "
-                        "expected %s but got %s" % (temp_file_name, hash_, md5)
-                    )
+        # check the hash
+        if hash_ is not None:
+            if verbose:
+                tqdm.write("Verifying download hash.", file=sys.stdout)
+            if hasher is None:
+                hasher = _hash_file(temp_file_name, algo)
+            digest = hasher.hexdigest()
+            if hash_ != digest:
+                raise RuntimeError(
+                    "Hash mismatch for downloaded file %s, "
+                    "expected %s but got %s" % (temp_file_name, hash_, digest)
+                )
         local_file_size = op.getsize(temp_file_name)
         if local_file_size != remote_file_size:
             if remote_file_size != remote_file_size_default:
@@ -272,20 +570,254 @@ def _fetch_file(
                     "* Please wait some time and try re-downloading the file again."
                     % (local_file_size, remote_file_size)
                 )
-        shutil.move(temp_file_name, file_name)
+        # The partial file sits next to the target, so this is a rename
+        os.replace(temp_file_name, file_name)
+        os.remove(part_meta_file_name)
+        if if_newer and scheme in ("http", "https"):
+            _write_meta(meta_file_name, source_url, u.headers)
     except Exception as ee:
         raise RuntimeError(
             "Error while fetching file %s."
             " Dataset fetching aborted.\nError: %s" % (url, ee)
         )
+    return True
+
+
+def _read_meta(meta_file_name):
+    """Read the sidecar metadata of a downloaded file, or {} if missing."""
+    try:
+        with open(meta_file_name, "r") as fid:
+            return json.load(fid)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_meta(meta_file_name, url, headers):
+    """Save the validators of a downloaded file, if the server sent any."""
+    meta = {
+        "url": url,
+        "etag": headers.get("ETag"),
+        "last_modified": headers.get("Last-Modified"),
+    }
+    if meta["etag"] is None and meta["last_modified"] is None:
+        if op.exists(meta_file_name):
+            os.remove(meta_file_name)
+        return
+    with open(meta_file_name, "w") as fid:
+        json.dump(meta, fid)
+
+
+def _write_part_meta(part_meta_file_name, url, final_url, headers, total_size):
+    """Save what a partial download is fetched against, to resume it later."""
+    meta = {
+        "url": url,
+        "final_url": final_url,
+        "etag": headers.get("ETag"),
+        "last_modified": headers.get("Last-Modified"),
+        "total_size": total_size,
+    }
+    with open(part_meta_file_name, "w") as fid:
+        json.dump(meta, fid)
+
+
+def _can_resume(meta, url, headers, total_size):
+    """Check that a partial download still matches the remote file."""
+    if meta.get("url") != url or meta.get("total_size") != total_size:
+        return False
+    if meta.get("etag") or headers.get("ETag"):
+        return meta.get("etag") == headers.get("ETag")
+    return meta.get("last_modified") == headers.get("Last-Modified")
+
+
+def _range_headers(meta, url, initial_size):
+    """Build the headers requesting the rest of a partial download."""
+    headers = {}
+    # Files downloaded in parallel ranges are created at their full size
+    # and cannot be resumed, so start over if the partial file is that big
+    if (
+        initial_size == 0
+        or initial_size >= meta.get("total_size", 0)
+        or meta.get("url") != url
+    ):
+        return headers
+    headers["Range"] = "bytes=%s-" % (initial_size,)
+    # Get the whole file rather than a range of it if it changed meanwhile
+    if meta.get("etag"):
+        headers["If-Range"] = meta["etag"]
+    elif meta.get("last_modified"):
+        headers["If-Range"] = meta["last_modified"]
+    return headers
+
+
+def _is_gzip_file(path):
+    """Tell whether a url or file name is that of a gzip compressed file."""
+    path = urllib.parse.urlparse(path).path if "://" in path else path
+    return path.lower().endswith((".gz", ".tgz"))
+
+
+def _size_description(size):
+    """Format a file size, or say that it is unknown."""
+    if size == remote_file_size_default:
+        return "unknown size"
+    return sizeof_fmt(size)
+
+
+def _content_length(response):
+    """Get the size of a response body, or the default if it is unknown."""
+    if getattr(response, "encoded", False):
+        # Only the size of the compressed body is known
+        return remote_file_size_default
+    return int(
+        response.headers.get("Content-Length", str(remote_file_size_default)).strip()
+    )
+
+
+def _content_range_total(headers):
+    """Get the full file size from the Content-Range of a 206 response."""
+    total = headers.get("Content-Range", "").rpartition("/")[2].strip()
+    if total.isdigit():
+        return int(total)
+    return remote_file_size_default
+
+
+def _conditional_headers(meta, url):
+    """Build the headers for a conditional request from saved metadata."""
+    headers = {}
+    # Validators are only meaningful for the url they were saved for
+    if meta.get("url") != url:
+        return headers
+    if meta.get("etag"):
+        headers["If-None-Match"] = meta["etag"]
+    if meta.get("last_modified"):
+        headers["If-Modified-Since"] = meta["last_modified"]
+    return headers
+
+
+def _stream_extract(
+    url, path, kind, timeout=10.0, progressbar=True, verbose=True, ncols=80
+):
+    """Download an archive and unpack it into ``path``.
+
+    Tar archives are extracted while they are being downloaded. Zip files
+    keep their index at the end, so they are first spooled to memory (or to
+    a temporary file for large archives) and extracted afterwards.
+    """
+    response = _open_url(url, timeout=timeout)
+    try:
+        file_size = _content_length(response)
+        if verbose:
+            tqdm.write(
+                "Downloading data from %s (%s)\n"
+                % (response.url, _size_description(file_size)),
+                file=sys.stdout,
+            )
+        with _progress_bar(file_size, ncols=ncols, progressbar=progressbar) as progress:
+            if kind == "zip":
+                from zipfile import ZipFile
+
+                # SpooledTemporaryFile is not seekable() for ZipFile before
+                # Python 3.11, so pick memory or disk from the announced size
+                if file_size == remote_file_size_default or file_size > ZIP_SPOOL_SIZE:
+                    archive = tempfile.TemporaryFile()
+                else:
+                    archive = io.BytesIO()
+                with archive:
+                    writer = _ProgressWriter(archive, progress)
+                    shutil.copyfileobj(response, writer, CHUNK_SIZE)
+                    progress.close()
+                    if verbose:
+                        tqdm.write(
+                            "Extracting {} file...".format(kind), file=sys.stdout
+                        )
+                    archive.seek(0)
+                    with ZipFile(archive) as myobj:
+                        _extract_zip(myobj, path)
+            else:
+                if verbose:
+                    tqdm.write("Extracting {} file...".format(kind), file=sys.stdout)
+                import tarfile
+
+                reader = _ProgressReader(response, progress)
+                with tarfile.open(fileobj=reader, mode=TAR_MODES[kind]) as myobj:
+                    myobj.extractall(path)
+                # Read up to the end so that truncated downloads are detected
+                while reader.read(COPY_SIZE):
+                    pass
+                if (
+                    file_size != remote_file_size_default
+                    and reader.bytes_read != file_size
+                ):
+                    raise RuntimeError(
+                        "Error: File size is %d and should be %d"
+                        % (reader.bytes_read, file_size)
+                    )
+    finally:
+        response.close()
+
+
+def _extract_zip(zip_file, path):
+    """Extract all members of an open ZipFile into ``path``.
+
+    Directories are created up front, then the files are decompressed and
+    written by a pool of threads.
+    """
+    if os.name == "nt":
+        # ZipFile has its own rules for names that are invalid on Windows
+        zip_file.extractall(path)
+        return
+    files = []
+    # Archives usually hold many files per folder, create each folder once
+    folders = set()
+    for member in zip_file.infolist():
+        target = _zip_member_path(path, member.filename)
+        if member.is_dir():
+            folder = target
+        else:
+            folder = op.dirname(target)
+            files.append((member, target))
+        if folder not in folders:
+            os.makedirs(folder, exist_ok=True)
+            folders.add(folder)
+
+    def extract(member, target):
+        with zip_file.open(member) as src, open(target, "wb") as dst:
+            shutil.copyfileobj(src, dst, COPY_SIZE)
+
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        futures = [executor.submit(extract, *item) for item in files]
+        for future in as_completed(futures):
+            future.result()
+
+
+def _zip_member_path(path, name):
+    """Return where ``name`` is extracted to, as ZipFile.extract does."""
+    name = name.replace("/", os.path.sep)
+    if os.path.altsep:
+        name = name.replace(os.path.altsep, os.path.sep)
+    name = op.splitdrive(name)[1]
+    invalid = ("", os.path.curdir, os.path.pardir)
+    name = os.path.sep.join(x for x in name.split(os.path.sep) if x not in invalid)
+    return op.normpath(op.join(path, name))
 
 
 def _get_ftp(
-    url, temp_file_name, initial_size, file_size, verbose_bool, progressbar, ncols=80
+    url,
+    temp_file_name,
+    initial_size,
+    file_size,
+    verbose_bool,
+    progressbar,
+    ncols=80,
+    hasher=None,
 ):
-    """Safely (resume a) download to a file from FTP."""
+    """Safely (resume a) download to a file from FTP.
+
+    If given, ``hasher`` is updated with every byte written to the file and
+    returned.
+    """
     # Adapted from: https://pypi.python.org/pypi/fileDownloader.py
     # but with changes
+    import ftplib
 
     parsed_url = urllib.parse.urlparse(url)
     file_name = os.path.basename(parsed_url.path)
@@ -301,96 +833,391 @@ def _get_ftp(
     if len(server_path) > 1:
         data.cwd(unquoted_server_path)
     data.sendcmd("TYPE I")
-    data.sendcmd("REST " + str(initial_size))
     down_cmd = "RETR " + file_name
-    assert file_size == data.size(file_name)
-    with tqdm(
-            total=file_size,
-            initial=initial_size,
-            desc="file_sizes",
-            ncols=ncols,
-            unit="B",
-            unit_scale=True,
-            file=sys.stdout,
-            disable=not progressbar
-        ) as progress:
-        # Callback lambda function that will be passed the downloaded data
-        # chunk and will write it to file and update the progress bar
-        mode = "ab" if initial_size > 0 else "wb"
-        with open(temp_file_name, mode) as local_file:
-
-            def chunk_write(chunk):
-                return _chunk_write(chunk, local_file, progress)
-
-            data.retrbinary(down_cmd, chunk_write)
+    remote_size = data.size(file_name)
+    if file_size == remote_file_size_default:
+        # Not every server tells the size when the file is first opened
+        file_size = remote_size
+    elif file_size != remote_size:
+        raise RuntimeError(
+            "Remote file size is %d, expected %d" % (remote_size, file_size)
+        )
+    with _progress_bar(
+        file_size, initial_size, ncols=ncols, progressbar=progressbar
+    ) as progress:
+        with _open_part_file(temp_file_name, initial_size, file_size) as local_file:
+            # Same loop as ftplib's retrbinary, but with our own data socket
+            # so that it is read in larger chunks.
+            conn = data.transfercmd(down_cmd, initial_size or None)
+            try:
+                with conn.makefile("rb", buffering=0) as fp:
+                    _copy_stream(fp, local_file, progress, hasher)
+            finally:
+                conn.close()
+            data.voidresp()
             data.close()
+    return hasher
 
 
 def _get_http(
-    url, temp_file_name, initial_size, file_size, verbose_bool, progressbar, ncols=80
+    url,
+    temp_file_name,
+    initial_size,
+    file_size,
+    verbose_bool,
+    progressbar,
+    ncols=80,
+    timeout=10.0,
+    num_connections=1,
+    hasher=None,
+    response=None,
 ):
-    """Safely (resume a) download to a file from http(s)."""
+    """Safely (resume a) download to a file from http(s).
+
+    If given, ``hasher`` is updated with every byte written to the file and
+    returned. None is returned instead if the file had to be downloaded out
+    of order, in which case it must be hashed from disk.
+
+    ``response`` may be an already open response for the file from
+    ``initial_size`` on, which is then read instead of issuing a new request.
+    With ``num_connections > 1``, it is requested with ``Range: bytes=0-`` so
+    that a 206 reply shows the server supports range requests.
+    """
     # Actually do the reading
-    req = request_agent(url)
+    headers = {}
     if initial_size > 0:
-        req.headers["Range"] = "bytes=%s-" % (initial_size,)
+        headers["Range"] = "bytes=%s-" % (initial_size,)
+    elif num_connections > 1:
+        headers["Range"] = "bytes=0-"
     try:
-        response = urllib.request.urlopen(req)
+        if response is None:
+            response = _open_url(url, timeout=timeout, headers=headers)
     except Exception:
+        if not headers:
+            raise
         # There is a problem that may be due to resuming, some
         # servers may not support the "Range" header. Switch
         # back to complete download method
-        tqdm.write(
-            "Resuming download failed (server "
-            "rejected the request). Attempting to "
-            "restart downloading the entire file.",
-            file=sys.stdout,
-        )
-        del req.headers["Range"]
-        response = urllib.request.urlopen(req)
-    total_size = int(
-        response.headers.get("Content-Length", str(remote_file_size_default)).strip()
-    )
-    if initial_size > 0 and file_size == total_size:
-        tqdm.write(
-            "Resuming download failed (resume file size "
-            "mismatch). Attempting to restart downloading the "
-            "entire file.",
-            file=sys.stdout,
-        )
-        initial_size = 0
-    total_size += initial_size
-    if total_size != file_size:
-        raise RuntimeError("URL could not be parsed properly")
-    mode = "ab" if initial_size > 0 else "wb"
-    with tqdm(
-            total=total_size,
-            initial=initial_size,
-            desc="file_sizes",
-            ncols=ncols,
-            unit="B",
-            unit_scale=True,
-            file=sys.stdout,
-            disable=not progressbar
+        if initial_size > 0:
+            tqdm.write(
+                "Resuming download failed (server "
+                "rejected the request). Attempting to "
+                "restart downloading the entire file.",
+                file=sys.stdout,
+            )
+        response = _open_url(url, timeout=timeout)
+    try:
+        # Partial files can only be resumed over a single connection, and
+        # servers answering with the whole file (200) get a single stream
+        if (
+            num_connections > 1
+            and initial_size == 0
+            and response.status == 206
+            and file_size != remote_file_size_default
+            and file_size >= RANGES_MIN_SIZE
+        ):
+            _get_http_ranges(
+                response,
+                temp_file_name,
+                file_size,
+                progressbar,
+                num_connections,
+                ncols,
+                timeout=timeout,
+            )
+            return None
+        total_size = _content_length(response)
+        if initial_size > 0 and response.status != 206:
+            tqdm.write(
+                "Resuming download failed (server ignored the "
+                "requested range). Restarting downloading the "
+                "entire file.",
+                file=sys.stdout,
+            )
+            initial_size = 0
+            if hasher is not None:
+                hasher = hashlib.new(hasher.name)
+        total_size += initial_size
+        if total_size != file_size:
+            raise RuntimeError("URL could not be parsed properly")
+        with _progress_bar(
+            total_size, initial_size, ncols=ncols, progressbar=progressbar
         ) as progress:
+            part_file = _open_part_file(temp_file_name, initial_size, total_size)
+            with part_file as local_file:
+                if hasher is None and _splice_to_file(
+                    response, local_file, progress, timeout
+                ):
+                    return None
+                if progressbar or hasher is not None:
+                    _copy_stream(response, local_file, progress, hasher)
+                else:
+                    # Nothing to report per chunk, so use a larger buffer
+                    _copy_stream(response, local_file, buffer_size=COPY_SIZE)
+    finally:
+        response.close()
+    return hasher
+
+
+def _splice_to_file(response, local_file, progress, timeout=None):
+    """Copy the body of a plain http response to a file within the kernel.
+
+    On Linux, ``os.splice`` moves the data from the socket to the file
+    through a pipe, without copying it into Python objects. Returns False
+    if the response cannot be spliced (https, chunked encoding, ...), in
+    which case the rest of the body must be copied as usual. Raises
+    ``socket.timeout`` if no data arrives for ``timeout`` seconds.
+    """
+    body = response.fp
+    if (
+        not hasattr(os, "splice")
+        or urllib.parse.urlparse(response.url).scheme != "http"
+        or not isinstance(body, http.client.HTTPResponse)
+        or body.chunked
+        or not body.length
+    ):
+        return False
+
+    # Bytes buffered by http.client while parsing the headers come first
+    head = response.read(min(len(body.fp.peek()), body.length))
+    _chunk_write(head, local_file, progress)
+    local_file.flush()
+    if not body.length:
+        return True
+    sock_fd = body.fp.fileno()
+    file_fd = local_file.fileno()
+
+    poller = select.poll()
+    poller.register(sock_fd, select.POLLIN)
+    poll_timeout = None if timeout is None else int(timeout * 1000)
+
+    spliced = 0
+    read_end, write_end = os.pipe()
+    try:
+        try:
+            import fcntl
+
+            fcntl.fcntl(write_end, fcntl.F_SETPIPE_SZ, CHUNK_SIZE)
+        except (ImportError, AttributeError, OSError):
+            pass
+        # http.client's count of the bytes left is kept up to date, so that
+        # the body can still be read through it if splicing has to stop
+        while body.length:
+            try:
+                n_in = os.splice(sock_fd, write_end, min(body.length, CHUNK_SIZE))
+            except BlockingIOError:
+                if not poller.poll(poll_timeout):
+                    raise socket.timeout(
+                        "No data received for %s seconds" % (timeout,)
+                    )
+                continue
+            except OSError:
+                if spliced == 0:
+                    return False
+                raise
+            if n_in == 0:
+                raise RuntimeError(
+                    "Connection closed with %s bytes left to read" % (body.length,)
+                )
+            body.length -= n_in
+            while n_in:
+                try:
+                    n_out = os.splice(read_end, file_fd, n_in)
+                except OSError:
+                    if spliced > 0:
+                        raise
+                    # The file system does not support splicing, so empty
+                    # the pipe by hand and fall back to a regular copy
+                    while n_in:
+                        chunk = os.read(read_end, n_in)
+                        _chunk_write(chunk, local_file, progress)
+                        n_in -= len(chunk)
+                    return False
+                n_in -= n_out
+                spliced += n_out
+                progress.update(n_out)
+        # Nothing is left to read, but this lets http.client release the
+        # connection
+        body.read()
+    finally:
+        os.close(read_end)
+        os.close(write_end)
+        if spliced:
+            # Let the file object know where the kernel left the file offset
+            local_file.seek(os.lseek(file_fd, 0, os.SEEK_CUR))
+    return True
+
+
+def _progress_bar(total, initial=0, ncols=80, progressbar=True):
+    """Create a progress bar for a download of ``total`` bytes.
+
+    The bar is only redrawn every 0.25 s, and updates are passed to it in
+    batches so that small chunks do not each go through tqdm. If ``total``
+    is unknown, only the number of bytes received is shown.
+    """
+    if total == remote_file_size_default:
+        total = None
+    progress = tqdm(
+        total=total,
+        initial=initial,
+        desc="file_sizes",
+        ncols=ncols,
+        unit="B",
+        unit_scale=True,
+        # Same units as sizeof_fmt
+        unit_divisor=1024,
+        file=sys.stdout,
+        disable=not progressbar,
+        mininterval=0.25,
+    )
+    return _BatchedProgress(progress)
+
+
+@contextmanager
+def _open_part_file(temp_file_name, initial_size, file_size):
+    """Open a partial download for writing from ``initial_size`` on.
+
+    The file is not preallocated, so that its size always tells how much of
+    it was downloaded, even if the process was killed before it could clean
+    up, and the download can be resumed from there.
+    """
+    mode = "r+b" if initial_size > 0 else "wb"
+    with open(temp_file_name, mode) as local_file:
+        local_file.seek(initial_size)
+        if file_size != remote_file_size_default:
+            _advise_sequential(local_file, file_size)
+        try:
+            yield local_file
+        finally:
+            local_file.truncate()
+
+
+def _preallocate(local_file, file_size):
+    """Reserve disk space for a file."""
+    if hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(local_file.fileno(), 0, file_size)
+        except OSError:
+            # Not supported by every file system
+            pass
+
+
+def _advise_sequential(local_file, file_size):
+    """Hint that a file is written in order."""
+    if hasattr(os, "posix_fadvise"):
+        try:
+            os.posix_fadvise(
+                local_file.fileno(), 0, file_size, os.POSIX_FADV_SEQUENTIAL
+            )
+        except OSError:
+            pass
+
+
+def _get_http_ranges(
+    response,
+    temp_file_name,
+    file_size,
+    progressbar,
+    num_connections,
+    ncols=80,
+    timeout=10.0,
+):
+    """Download a file from http(s) using parallel range requests.
+
+    ``response`` is a 206 response for the whole file, requested with
+    ``Range: bytes=0-``. It is used for the first segment, and the others
+    are requested from ``response.url``.
+    """
+    url = response.url
+    # Split the file into one contiguous segment per connection
+    bounds = [file_size * ii // num_connections for ii in range(num_connections + 1)]
+    segments = [
+        (start, stop) for start, stop in zip(bounds, bounds[1:]) if stop > start
+    ]
+    lock = threading.Lock()
+    try:
+        with _progress_bar(file_size, ncols=ncols, progressbar=progressbar) as progress:
+            with open(temp_file_name, "wb") as local_file:
+                local_file.truncate(file_size)
+                _preallocate(local_file, file_size)
+                with ThreadPoolExecutor(max_workers=len(segments)) as executor:
+                    futures = [
+                        executor.submit(
+                            _get_http_range,
+                            url,
+                            local_file,
+                            start,
+                            stop,
+                            progress,
+                            lock,
+                            timeout=timeout,
+                            # Ranges start at 0, so the first one is served
+                            # by the request that is already open
+                            response=response if start == 0 else None,
+                        )
+                        for start, stop in segments
+                    ]
+                    for future in futures:
+                        future.result()
+    except Exception:
+        # A partially filled file cannot be resumed, so start over next time
+        if op.exists(temp_file_name):
+            os.remove(temp_file_name)
+        raise
+    return True
+
 
-        chunk_size = 8192  # 2 ** 13
-        with open(temp_file_name, mode) as local_file:
-            while True:
-                t0 = time.time()
-                chunk = response.read(chunk_size)
-                dt = time.time() - t0
-                if dt < 0.005:
-                    chunk_size *= 2
-                elif dt > 0.1 and chunk_size > 8192:
-                    chunk_size = chunk_size // 2
-                if not chunk:
-                    break
-                local_file.write(chunk)
+def _get_http_range(
+    url, local_file, start, stop, progress, lock, timeout=10.0, response=None
+):
+    """Download bytes ``[start, stop)`` of a file into ``local_file``.
+
+    ``response`` may be an open 206 response starting at ``start``, which is
+    then read up to ``stop`` and closed.
+    """
+    if response is None:
+        response = _open_url(
+            url,
+            timeout=timeout,
+            headers={"Range": "bytes=%s-%s" % (start, stop - 1)},
+        )
+    try:
+        if response.status != 206:
+            raise RuntimeError(
+                "Server did not honor the range request for bytes %s-%s"
+                % (start, stop - 1)
+            )
+        offset = start
+        while offset < stop:
+            chunk = response.read(min(CHUNK_SIZE, stop - offset))
+            if not chunk:
+                raise RuntimeError(
+                    "Connection closed after %s of %s bytes"
+                    % (offset - start, stop - start)
+                )
+            _write_at(local_file, chunk, offset, lock)
+            offset += len(chunk)
+            with lock:
                 progress.update(len(chunk))
+    finally:
+        response.close()
 
 
-def md5sum(fname, block_size=1048576):  # 2 ** 20
+def _write_at(local_file, chunk, offset, lock):
+    """Write a chunk at a given offset of a file shared between threads."""
+    if hasattr(os, "pwrite"):
+        view = memoryview(chunk)
+        while view:
+            written = os.pwrite(local_file.fileno(), view, offset)
+            view = view[written:]
+            offset += written
+    else:
+        with lock:
+            local_file.seek(offset)
+            local_file.write(chunk)
+
+
+def md5sum(fname, block_size=COPY_SIZE):
     """Calculate the md5sum for a file.
 
     Parameters
@@ -398,30 +1225,116 @@ def md5sum(fname, block_size=1048576):  # 2 ** 20
     fname : str
         Filename.
     block_size : int
-        Block size to use when reading.
+        Block size to use when reading, if ``hashlib.file_digest`` is not
+        available.
 
     Returns
     -------
     hash_ : str
         The hexadecimal digest of the hash.
     """
-    md5 = hashlib.md5()
+    return _hash_file(fname, "md5", block_size).hexdigest()
+
+
+def _copy_stream(src, local_file, progress=None, hasher=None, buffer_size=CHUNK_SIZE):
+    """Copy a stream into a file, reusing a single buffer for every chunk."""
+    view = memoryview(bytearray(buffer_size))
+    while True:
+        n_read = src.readinto(view)
+        if not n_read:
+            break
+        _chunk_write(view[:n_read], local_file, progress, hasher)
+
+
+def _hash_file(fname, algorithm, block_size=COPY_SIZE):
+    """Hash the contents of a file and return the hash object."""
     with open(fname, "rb") as fid:
-        while True:
-            data = fid.read(block_size)
-            if not data:
-                break
-            md5.update(data)
-    return md5.hexdigest()
+        if hasattr(hashlib, "file_digest"):
+            # Python 3.11+ reads and hashes the whole file in C
+            return hashlib.file_digest(fid, algorithm)
+        hasher = hashlib.new(algorithm)
+        if os.fstat(fid.fileno()).st_size == 0:
+            # Empty files cannot be memory mapped
+            return hasher
+        # Hash slices of the mapped file, which does not copy the data
+        with mmap.mmap(fid.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            view = memoryview(mapped)
+            try:
+                for start in range(0, len(view), block_size):
+                    hasher.update(view[start : start + block_size])
+            finally:
+                view.release()
+    return hasher
 
 
-def _chunk_write(chunk, local_file, progress):
-    """Write a chunk to file and update the progress bar."""
+def _chunk_write(chunk, local_file, progress, hasher=None):
+    """Write a chunk to file, update the progress bar and hash."""
+    if hasher is not None:
+        hasher.update(chunk)
     local_file.write(chunk)
     if progress is not None:
         progress.update(len(chunk))
 
 
+class _BatchedProgress(object):
+    """Wrapper forwarding updates to a tqdm bar once they add up to a batch."""
+
+    def __init__(self, progress, batch_size=1048576):  # noqa: D107
+        self._progress = progress
+        self._batch_size = batch_size
+        self._pending = 0
+        if progress.disable:
+            # Nothing is shown, so do not even count
+            self.update = lambda n: None
+
+    def update(self, n):  # noqa: D102
+        self._pending += n
+        if self._pending >= self._batch_size:
+            self.flush()
+
+    def flush(self):  # noqa: D102
+        if self._pending:
+            self._progress.update(self._pending)
+            self._pending = 0
+
+    def close(self):  # noqa: D102
+        self.flush()
+        self._progress.close()
+
+    def __enter__(self):  # noqa: D105
+        return self
+
+    def __exit__(self, *exc_info):  # noqa: D105
+        self.close()
+
+
+class _ProgressWriter(object):
+    """File-like wrapper that updates a progress bar on each write."""
+
+    def __init__(self, local_file, progress):  # noqa: D107
+        self._local_file = local_file
+        self._progress = progress
+
+    def write(self, chunk):  # noqa: D102
+        _chunk_write(chunk, self._local_file, self._progress)
+        return len(chunk)
+
+
+class _ProgressReader(object):
+    """File-like wrapper that updates a progress bar on each read."""
+
+    def __init__(self, fp, progress):  # noqa: D107
+        self._fp = fp
+        self._progress = progress
+        self.bytes_read = 0
+
+    def read(self, amt=None):  # noqa: D102
+        chunk = self._fp.read(amt)
+        self.bytes_read += len(chunk)
+        self._progress.update(len(chunk))
+        return chunk
+
+
 def sizeof_fmt(num):
     """Turn number of bytes into human-readable str.
 
@@ -435,15 +1348,13 @@ def sizeof_fmt(num):
     size : str
         The size in human-readable format.
     """
-    units = ["bytes", "kB", "MB", "GB", "TB", "PB"]
-    decimals = [0, 0, 1, 2, 2, 2]
     if num > 1:
-        exponent = min(int(log(num, 1024)), len(units) - 1)
-        quotient = float(num) / 1024 ** exponent
-        unit = units[exponent]
-        num_decimals = decimals[exponent]
-        format_string = "{0:.%sf} {1}" % (num_decimals)
-        return format_string.format(quotient, unit)
+        # Each unit is 2 ** 10 times the previous one
+        exponent = min((int(num).bit_length() - 1) // 10, len(SIZE_UNITS) - 1)
+        quotient = float(num) / (1 << (10 * exponent))
+        return "{0:.{1}f} {2}".format(
+            quotient, SIZE_DECIMALS[exponent], SIZE_UNITS[exponent]
+        )
     if num == 0:
         return "0 bytes"
     if num == 1:
@@ -474,12 +1385,181 @@ class _TempDir(str):
 
 
 def request_agent(url):
-    req = urllib.request.Request(
-        url,
-        data=None,
-        # Simulate a user-agent because some websites require it for this to work
-        headers={
-            "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_3) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/35.0.1916.47 Safari/537.36"
-        },
-    )
+    req = urllib.request.Request(url, data=None, headers={"User-Agent": USER_AGENT})
     return req
+
+
+def get_session():
+    """Return the requests session shared by all downloads.
+
+    Reusing a single session keeps connections alive between requests, so
+    that repeated downloads from the same host skip the TCP and TLS
+    handshakes.
+
+    Returns
+    -------
+    session : requests.Session | None
+        The shared session, or None if ``requests`` is not installed.
+    """
+    global _session
+    if _session is None:
+        try:
+            import requests
+        except ModuleNotFoundError:
+            return None
+        with _session_lock:
+            if _session is None:
+                from requests.adapters import HTTPAdapter
+                from urllib3.util.retry import Retry
+
+                session = requests.Session()
+                # Keep enough connections per host for download_many and
+                # parallel range requests, and retry transient server errors
+                retries = Retry(
+                    total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504]
+                )
+                for prefix in ("https://", "http://"):
+                    session.mount(
+                        prefix,
+                        HTTPAdapter(
+                            pool_connections=16, pool_maxsize=32, max_retries=retries
+                        ),
+                    )
+                session.headers["User-Agent"] = USER_AGENT
+                # Content-Length must match the number of bytes on disk
+                session.headers["Accept-Encoding"] = "identity"
+                _session = session
+    return _session
+
+
+class _Response(object):
+    """Streaming HTTP response, backed by either requests or urllib."""
+
+    def __init__(self, fp, status, headers, url, close):  # noqa: D107
+        # requests wraps the http.client response in a urllib3 one, whose
+        # readinto allocates a new bytes object per call. Read from
+        # http.client directly so buffers are filled in place. _fp is not
+        # public, but the same in urllib3 1.x and 2.x (pinned in setup.py),
+        # and the urllib3 response is read instead if it ever goes away.
+        self._raw = fp
+        body = getattr(fp, "_fp", None)
+        if not isinstance(body, http.client.HTTPResponse):
+            body = fp
+        self._body = self.fp = body
+        self.status = status
+        self.headers = headers
+        self.url = url
+        self._close = close
+        # Whether the body is decompressed, in which case Content-Length is
+        # the compressed size rather than that of the file
+        self.encoded = False
+
+    def decode(self):
+        """Decompress a gzip or deflate encoded body as it is read.
+
+        Only to be used if compression was asked for in the request, as
+        some servers mark compressed files (.gz) as encoded.
+        """
+        encoding = self.headers.get("Content-Encoding", "").strip().lower()
+        if encoding in ("gzip", "x-gzip", "deflate"):
+            self.fp = _DecodedReader(self.fp, encoding)
+            self.encoded = True
+
+    def read(self, amt=None):  # noqa: D102
+        data = self.fp.read(amt)
+        if not data and amt != 0:
+            self._check_complete()
+        return data
+
+    def readinto(self, b):  # noqa: D102
+        n = self.fp.readinto(b)
+        if not n and len(b):
+            self._check_complete()
+        return n
+
+    def _check_complete(self):
+        # http.client only counts down Content-Length, and does not complain
+        # when the connection closes before all of it was received
+        length = getattr(self._body, "length", None)
+        if length:
+            raise http.client.IncompleteRead(b"", length)
+
+    def close(self):  # noqa: D102
+        if self._raw is not self._body and self._body.isclosed():
+            # The body was read to the end, so keep the connection alive
+            self._raw.release_conn()
+        self._close()
+
+
+class _DecodedReader(object):
+    """Decompress a gzip or deflate encoded response body as it is read."""
+
+    def __init__(self, fp, encoding):  # noqa: D107
+        self._fp = fp
+        # 32 + 15 accepts both gzip and zlib headers
+        self._decoder = zlib.decompressobj(47 if "gzip" in encoding else 15)
+
+    def readinto(self, b):  # noqa: D102
+        while True:
+            data = self._decoder.unconsumed_tail
+            if not data:
+                if self._decoder.eof:
+                    return 0
+                data = self._fp.read(CHUNK_SIZE)
+                if not data:
+                    raise RuntimeError("Compressed response ended unexpectedly")
+            chunk = self._decoder.decompress(data, len(b))
+            if chunk:
+                b[: len(chunk)] = chunk
+                return len(chunk)
+
+    def read(self, amt=None):  # noqa: D102
+        if amt is not None:
+            buf = bytearray(amt)
+            return bytes(buf[: self.readinto(buf)])
+        chunks = []
+        chunk = self.read(CHUNK_SIZE)
+        while chunk:
+            chunks.append(chunk)
+            chunk = self.read(CHUNK_SIZE)
+        return b"".join(chunks)
+
+
+def _is_http_error(err):
+    """Tell whether an exception raised by _open_url is an error status."""
+    # requests' HTTPError keeps the response, urllib's is the response
+    return isinstance(err, urllib.error.HTTPError) or (
+        getattr(err, "response", None) is not None
+    )
+
+
+def _open_url(url, timeout=None, headers=None):
+    """Open a url, following redirects.
+
+    The shared requests session is used for http(s) when available, with
+    urllib as a fallback and for other schemes. Error statuses raise an
+    exception.
+    """
+    headers = headers or {}
+    session = get_session()
+    scheme = urllib.parse.urlparse(url).scheme
+    if "dropbox.com" in url and session is None:
+        # Dropbox needs cookies, which requests handles for us
+        raise ValueError(
+            "To download Dropbox links, you need to "
+            "install the `requests` module."
+        )
+    if session is not None and scheme in ("http", "https"):
+        resp = session.get(url, headers=headers, timeout=timeout, stream=True)
+        resp.raise_for_status()
+        return _Response(resp.raw, resp.status_code, resp.headers, resp.url, resp.close)
+    req = request_agent(url)
+    req.headers.update(headers)
+    try:
+        resp = urllib.request.urlopen(req, timeout=timeout)
+    except urllib.error.HTTPError as err:
+        # Answer to a conditional request, not an error
+        if err.code != 304:
+            raise
+        resp = err
+    return _Response(resp, resp.getcode(), resp.headers, resp.geturl(), resp.close)
@@ -1,17 +1,164 @@
-from numpy.testing import assert_equal, assert_array_equal, assert_allclose
 import pytest
 import os.path as op
 import os
-from download import download
-from download.download import _fetch_file, sizeof_fmt, _TempDir
+import re
+import shutil
+import sys
+import threading
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+import asyncio
+import bz2
+import hashlib
+import http.client
+import gzip
+import io
+import lzma
+import zlib
+from zipfile import ZipFile
+from download import download, download_many, download_many_async, get_session
+from download.download import (
+    _fetch_file,
+    sizeof_fmt,
+    _TempDir,
+    _convert_url_to_downloadable,
+    md5sum,
+    _extract_zip,
+    _can_resume,
+    _DecodedReader,
+    _write_part_meta,
+    _open_url,
+    _open_part_file,
+)
+
+
+DATA_PATH = op.dirname(__file__)
+
+
+class _QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope="session")
+def http_server():
+    """Serve the test data folder over http."""
+    server = ThreadingHTTPServer(
+        ("127.0.0.1", 0), partial(_QuietHandler, directory=DATA_PATH)
+    )
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield "http://127.0.0.1:%d" % server.server_port
+    server.shutdown()
+    server.server_close()
+
+
+class _RangeHandler(_QuietHandler):
+    """Handler adding ETags, single byte range requests and gzip encoding."""
+
+    def send_head(self):
+        path = self.translate_path(self.path)
+        if not op.isfile(path):
+            return _QuietHandler.send_head(self)
+        self.server.requests.append(dict(self.headers))
+        with open(path, "rb") as fid:
+            data = fid.read()
+        etag = _etag(data)
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return None
+        match = re.match(r"bytes=(\d+)-(\d*)$", self.headers.get("Range", ""))
+        # Like most servers, only compress files that are not binary data
+        binary = self.guess_type(path) == "application/octet-stream"
+        if match and int(match.group(1)) >= len(data):
+            self.send_error(416)
+            return None
+        if match:
+            start = int(match.group(1))
+            stop = int(match.group(2) or len(data) - 1) + 1
+            body = data[start:stop]
+            self.send_response(206)
+            self.send_header(
+                "Content-Range", "bytes %d-%d/%d" % (start, stop - 1, len(data))
+            )
+        elif path.endswith(".gz"):
+            # Like many servers, mark .gz files as gzip encoded data
+            body = data
+            self.send_response(200)
+            self.send_header("Content-Encoding", "gzip")
+        elif "gzip" in self.headers.get("Accept-Encoding", "") and not binary:
+            body = gzip.compress(data)
+            self.send_response(200)
+            self.send_header("Content-Encoding", "gzip")
+        else:
+            body = data
+            self.send_response(200)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        return io.BytesIO(body)
+
+
+def _etag(data):
+    return '"%s"' % hashlib.md5(data).hexdigest()
+
+
+@pytest.fixture
+def range_server(tmp_path):
+    """Serve a copy of the test data folder, with range and ETag support."""
+    for name in ("test.zip", "test.tar", "test.tar.gz"):
+        shutil.copy(op.join(DATA_PATH, name), str(tmp_path))
+    with open(op.join(DATA_PATH, "test.tar"), "rb") as fid:
+        tar = fid.read()
+    (tmp_path / "test.tar.bz2").write_bytes(bz2.compress(tar))
+    (tmp_path / "test.tar.xz").write_bytes(lzma.compress(tar))
+    server = ThreadingHTTPServer(
+        ("127.0.0.1", 0), partial(_RangeHandler, directory=str(tmp_path))
+    )
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def _server_url(server, name):
+    return "http://127.0.0.1:%d/%s" % (server.server_port, name)
+
+
+@pytest.fixture(scope="session")
+def ftp_server():
+    """Serve the test data folder over ftp."""
+    servers = pytest.importorskip("pyftpdlib.servers")
+    from pyftpdlib.authorizers import DummyAuthorizer
+    from pyftpdlib.handlers import FTPHandler
+
+    authorizer = DummyAuthorizer()
+    authorizer.add_anonymous(DATA_PATH)
+    handler = type("Handler", (FTPHandler,), {"authorizer": authorizer})
+    server = servers.ThreadedFTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(
+        target=server.serve_forever, kwargs=dict(handle_exit=False), daemon=True
+    )
+    thread.start()
+    yield "ftp://127.0.0.1:%d" % server.address[1]
+    server.close_all()
 
 
 def _test_fetch(url):
     """Helper to test URL retrieval."""
     tempdir = _TempDir()
+    with open(op.join(DATA_PATH, "test.zip"), "rb") as fid:
+        expected = fid.read()
 
     archive_name = op.join(tempdir, "download_test")
     _fetch_file(url, archive_name, timeout=30.0, verbose=False, resume=False)
+    with open(archive_name, "rb") as fid:
+        assert fid.read() == expected
 
     with pytest.raises(Exception):
         _fetch_file("NOT_AN_ADDRESS", op.join(tempdir, "test"), verbose=False)
@@ -20,59 +167,430 @@ def _test_fetch(url):
     with open(resume_name + ".part", "w"):
         os.utime(resume_name + ".part", None)
     _fetch_file(url, resume_name, resume=True, timeout=30.0, verbose=False)
+    with open(resume_name, "rb") as fid:
+        assert fid.read() == expected
     with pytest.raises(ValueError):
         _fetch_file(url, archive_name, hash_="a", verbose=False)
     with pytest.raises(RuntimeError):
         _fetch_file(url, archive_name, hash_="a" * 32, verbose=False)
+    sha256 = hashlib.sha256(expected).hexdigest()
+    _fetch_file(url, archive_name, hash_=sha256, verbose=False, algo="sha256")
+    with pytest.raises(ValueError):
+        _fetch_file(url, archive_name, hash_="a" * 32, verbose=False, algo="sha256")
 
 
-def test_fetch_file_html():
+def test_fetch_file_html(http_server):
     """Test file downloading over http."""
-    _test_fetch("http://google.com")
+    _test_fetch(http_server + "/test.zip")
 
 
-def test_fetch_file_ftp():
+def test_fetch_file_ftp(ftp_server):
     """Test file downloading over ftp."""
-    _test_fetch("ftp://speedtest.tele2.net/1KB.zip")
+    _test_fetch(ftp_server + "/test.zip")
+
+
+def test_fetch_file_ranges(range_server, monkeypatch):
+    """Test downloading a file over several connections."""
+    # Split even the small test files into ranges
+    monkeypatch.setattr(sys.modules[_fetch_file.__module__], "RANGES_MIN_SIZE", 1)
+    tempdir = _TempDir()
+    with open(op.join(DATA_PATH, "test.zip"), "rb") as fid:
+        expected = fid.read()
+    file_name = op.join(tempdir, "test.zip")
+    url = _server_url(range_server, "test.zip")
+    _fetch_file(url, file_name, verbose=False, progressbar=False, num_connections=4)
+    with open(file_name, "rb") as fid:
+        assert fid.read() == expected
+    # The first request gives the size and serves the first range
+    ranges = [headers.get("Range") for headers in range_server.requests]
+    assert ranges[0] == "bytes=0-"
+    assert len(ranges) == 4
+    assert all(r is not None for r in ranges)
+
+
+def test_fetch_file_ranges_unsupported(http_server, monkeypatch):
+    """Test a single stream is used if the server ignores ranges."""
+    monkeypatch.setattr(sys.modules[_fetch_file.__module__], "RANGES_MIN_SIZE", 1)
+    tempdir = _TempDir()
+    file_name = op.join(tempdir, "test.zip")
+    url = http_server + "/test.zip"
+    _fetch_file(url, file_name, verbose=False, progressbar=False, num_connections=4)
+    with open(file_name, "rb") as fid:
+        with open(op.join(DATA_PATH, "test.zip"), "rb") as ref:
+            assert fid.read() == ref.read()
+
+
+def test_fetch_file_resume(range_server):
+    """Test a partial download is resumed with a range request."""
+    tempdir = _TempDir()
+    with open(op.join(DATA_PATH, "test.zip"), "rb") as fid:
+        expected = fid.read()
+    file_name = op.join(tempdir, "test.zip")
+    url = _server_url(range_server, "test.zip")
+    with open(file_name + ".part", "wb") as fid:
+        fid.write(expected[:100])
+    headers = {"ETag": _etag(expected)}
+    _write_part_meta(file_name + ".part.json", url, url, headers, len(expected))
+    _fetch_file(url, file_name, verbose=False, progressbar=False)
+    with open(file_name, "rb") as fid:
+        assert fid.read() == expected
+    assert range_server.requests[0]["Range"] == "bytes=100-"
+    assert not op.exists(file_name + ".part.json")
+
+
+class _ShortHandler(_QuietHandler):
+    """Handler closing the connection before the announced length is sent."""
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "1000")
+        self.end_headers()
+        self.wfile.write(b"x" * 10)
+        self.close_connection = True
+
+
+def test_fetch_file_short_read():
+    """Test a truncated response is not taken for a complete one."""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _ShortHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        tempdir = _TempDir()
+        file_name = op.join(tempdir, "short.bin")
+        url = _server_url(server, "short.bin")
+        response = _open_url(url)
+        try:
+            with pytest.raises(http.client.IncompleteRead):
+                while response.read(100):
+                    pass
+        finally:
+            response.close()
+        with pytest.raises(RuntimeError, match="left to read|IncompleteRead"):
+            _fetch_file(url, file_name, hash_="0" * 32, verbose=False)
+        assert not op.exists(file_name)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_fetch_file_range_rejected(range_server, tmp_path, monkeypatch):
+    """Test the whole file is downloaded if the server rejects a range."""
+    tempdir = _TempDir()
+    with open(op.join(DATA_PATH, "test.zip"), "rb") as fid:
+        expected = fid.read()
+    file_name = op.join(tempdir, "test.zip")
+    url = _server_url(range_server, "test.zip")
+    # The file shrank on the server since the partial download started
+    with open(file_name + ".part", "wb") as fid:
+        fid.write(b"x" * (len(expected) + 10))
+    headers = {"ETag": _etag(expected)}
+    _write_part_meta(file_name + ".part.json", url, url, headers, 2 * len(expected))
+    _fetch_file(url, file_name, verbose=False, progressbar=False)
+    with open(file_name, "rb") as fid:
+        assert fid.read() == expected
+    assert not op.exists(file_name + ".part.json")
+    ranges = [headers.get("Range") for headers in range_server.requests]
+    assert ranges == ["bytes=%d-" % (len(expected) + 10), None]
+
+    # Servers answer 416 to ranges of empty files
+    monkeypatch.setattr(sys.modules[_fetch_file.__module__], "RANGES_MIN_SIZE", 1)
+    (tmp_path / "empty.txt").write_bytes(b"")
+    file_name = op.join(tempdir, "empty.txt")
+    url = _server_url(range_server, "empty.txt")
+    _fetch_file(url, file_name, verbose=False, progressbar=False, num_connections=4)
+    assert op.getsize(file_name) == 0
+
+
+def test_fetch_file_if_newer(range_server):
+    """Test an unchanged file is revalidated instead of downloaded again."""
+    tempdir = _TempDir()
+    with open(op.join(DATA_PATH, "test.zip"), "rb") as fid:
+        expected = fid.read()
+    file_name = op.join(tempdir, "test.zip")
+    url = _server_url(range_server, "test.zip")
+    _fetch_file(url, file_name, verbose=False, progressbar=False)
+    assert not op.exists(file_name + ".meta")
+    _fetch_file(url, file_name, verbose=False, progressbar=False, if_newer=True)
+    assert op.isfile(file_name + ".meta")
+    del range_server.requests[:]
+    assert not _fetch_file(
+        url, file_name, verbose=False, progressbar=False, if_newer=True
+    )
+    assert range_server.requests[0]["If-None-Match"] == _etag(expected)
+    with open(file_name, "rb") as fid:
+        assert fid.read() == expected
+
+
+def test_fetch_file_gzip(range_server, capsys):
+    """Test compressed responses are only decoded if compression was asked."""
+    tempdir = _TempDir()
+    for name in ("test.tar", "test.tar.gz"):
+        with open(op.join(DATA_PATH, name), "rb") as fid:
+            expected = fid.read()
+        file_name = op.join(tempdir, name)
+        del range_server.requests[:]
+        _fetch_file(_server_url(range_server, name), file_name, progressbar=False)
+        with open(file_name, "rb") as fid:
+            assert fid.read() == expected
+        encoding = range_server.requests[0].get("Accept-Encoding", "")
+        assert ("gzip" in encoding) == (name == "test.tar")
+    # The size of the decoded file is not known beforehand
+    out = capsys.readouterr().out
+    assert "test.tar (unknown size)" in out
+    assert "test.tar.gz (%s)" % sizeof_fmt(len(expected)) in out
+
+
+@pytest.mark.skipif(not hasattr(os, "splice"), reason="requires os.splice")
+def test_fetch_file_splice_fallback(range_server, tmp_path, monkeypatch):
+    """Test the download completes if the file cannot be spliced into."""
+    data = os.urandom(4 * 1048576)
+    (tmp_path / "big.bin").write_bytes(data)
+    splice = os.splice
+
+    def splice_to_socket_only(src, dst, count, *args, **kwargs):
+        if op.isfile("/proc/self/fd/%d" % dst):
+            raise OSError("splice to files is not supported")
+        return splice(src, dst, count, *args, **kwargs)
+
+    monkeypatch.setattr(os, "splice", splice_to_socket_only)
+    tempdir = _TempDir()
+    file_name = op.join(tempdir, "big.bin")
+    url = _server_url(range_server, "big.bin")
+    _fetch_file(url, file_name, verbose=False, progressbar=False, timeout=2.0)
+    with open(file_name, "rb") as fid:
+        assert fid.read() == data
+
+
+def test_open_part_file():
+    """Test partial files only ever hold the bytes written to them."""
+    tempdir = _TempDir()
+    file_name = op.join(tempdir, "test.part")
+    with _open_part_file(file_name, 0, 1000000) as fid:
+        fid.write(b"x" * 10)
+        fid.flush()
+        # What is on disk if the process gets killed here can be resumed
+        assert op.getsize(file_name) == 10
+    with _open_part_file(file_name, 10, 1000000) as fid:
+        fid.write(b"y" * 10)
+    with open(file_name, "rb") as fid:
+        assert fid.read() == b"x" * 10 + b"y" * 10
+
+
+def test_response_reads_http_client(http_server):
+    """Test responses from requests are read from http.client directly."""
+    response = _open_url(http_server + "/test.zip")
+    try:
+        if get_session() is not None:
+            # Catch urllib3 releases that no longer wrap http.client this way
+            assert isinstance(response.fp, http.client.HTTPResponse)
+        with open(op.join(DATA_PATH, "test.zip"), "rb") as fid:
+            assert response.read() == fid.read()
+    finally:
+        response.close()
 
 
 def test_sizeof_fmt():
     """Test sizeof_fmt."""
-    assert_equal(sizeof_fmt(0), "0 bytes")
-    assert_equal(sizeof_fmt(1), "1 byte")
-    assert_equal(sizeof_fmt(1000), "1000 bytes")
+    assert sizeof_fmt(0) == "0 bytes"
+    assert sizeof_fmt(1) == "1 byte"
+    assert sizeof_fmt(1000) == "1000 bytes"
+    assert sizeof_fmt(1024) == "1 kB"
+    assert sizeof_fmt(1048576) == "1.0 MB"
+    assert sizeof_fmt(1073741823) == "1024.0 MB"
+
+
+def test_md5sum():
+    """Test md5sum."""
+    fname = op.join(op.dirname(__file__), "test.zip")
+    with open(fname, "rb") as fid:
+        expected = hashlib.md5(fid.read()).hexdigest()
+    assert md5sum(fname) == expected
+    tempdir = _TempDir()
+    empty = op.join(tempdir, "empty")
+    open(empty, "w").close()
+    assert md5sum(empty) == hashlib.md5().hexdigest()
+
+
+def test_extract_zip():
+    """Test zip extraction matches ZipFile.extractall."""
+    tempdir = _TempDir()
+    fname = op.join(tempdir, "test.zip")
+    with ZipFile(fname, "w") as myobj:
+        myobj.writestr("a/", "")
+        myobj.writestr("a/b/c.txt", "c")
+        myobj.writestr("../d.txt", "d")
+    with ZipFile(fname) as myobj:
+        _extract_zip(myobj, op.join(tempdir, "out"))
+    assert op.isdir(op.join(tempdir, "out", "a"))
+    with open(op.join(tempdir, "out", "a", "b", "c.txt")) as fid:
+        assert fid.read() == "c"
+    # Names are not allowed to escape the output folder
+    assert op.exists(op.join(tempdir, "out", "d.txt"))
+    assert not op.exists(op.join(tempdir, "d.txt"))
+
+
+def test_can_resume():
+    """Test partial downloads are only resumed for an unchanged file."""
+    url = "http://example.com/data.csv"
+    meta = {"url": url, "etag": '"abc"', "last_modified": None, "total_size": 10}
+    assert _can_resume(meta, url, {"ETag": '"abc"'}, 10)
+    assert not _can_resume(meta, url, {"ETag": '"def"'}, 10)
+    assert not _can_resume(meta, url, {"ETag": '"abc"'}, 11)
+    assert not _can_resume(meta, "http://example.com/other.csv", {}, 10)
+    assert not _can_resume({}, url, {}, 10)
+    meta = {"url": url, "etag": None, "last_modified": None, "total_size": 10}
+    assert _can_resume(meta, url, {}, 10)
+
+
+def test_decoded_reader():
+    """Test compressed response bodies are decompressed while read."""
+    data = b"0123456789" * 100000
+    bodies = (("gzip", gzip.compress(data)), ("deflate", zlib.compress(data)))
+    for encoding, body in bodies:
+        reader = _DecodedReader(io.BytesIO(body), encoding)
+        assert reader.read(10) == data[:10]
+        assert reader.read() == data[10:]
+        assert reader.read(10) == b""
+    reader = _DecodedReader(io.BytesIO(gzip.compress(data)[:100]), "gzip")
+    with pytest.raises(RuntimeError):
+        reader.read()
+
+
+def test_convert_url_to_downloadable():
+    """Test share links are converted to direct download links."""
+    url = "https://drive.google.com/file/d/0B8VZ4vaOYWZ3c/view?usp=sharing"
+    assert (
+        _convert_url_to_downloadable(url)
+        == "https://drive.google.com/uc?export=download&id=0B8VZ4vaOYWZ3c"
+    )
+    url = "https://www.dropbox.com/s/rlndt99tss65418/citation.png?dl=0"
+    assert _convert_url_to_downloadable(url) == url.replace("dl=0", "dl=1")
+    url = "https://dl.dropbox.com/s/rlndt99tss65418/data.csv?dl=0"
+    assert _convert_url_to_downloadable(url) == url.replace("dl=0", "dl=1")
+    url = "https://github.com/choldgraf/download/blob/master/download/tests/test.zip"
+    assert _convert_url_to_downloadable(url) == url + "?raw=true"
+    assert _convert_url_to_downloadable(url + "?raw=true") == url + "?raw=true"
+    assert _convert_url_to_downloadable(url + "?a=b") == url + "?a=b&raw=true"
+    url = "https://github.com/choldgraf/download"
+    assert _convert_url_to_downloadable(url) == url
+    url = "http://example.com/data.csv?from=dropbox.com"
+    assert _convert_url_to_downloadable(url) == url
+    with pytest.raises(ValueError):
+        _convert_url_to_downloadable("https://drive.google.com/open")
 
 
-def test_download_func():
+def test_download_existing():
+    """Test existing data is kept without touching the url."""
+    tempdir = _TempDir()
+    path = op.join(tempdir, "myfile.txt")
+    with open(path, "w") as fid:
+        fid.write("data")
+    # This url cannot be converted, but it is never looked at
+    assert download("https://drive.google.com/open", path, verbose=False) == path
+    with open(path) as fid:
+        assert fid.read() == "data"
+
+
+def test_download_func(http_server):
     """Test the main download function."""
     tempdir = _TempDir()
-    path = download("http://google.com", op.join(tempdir, "./myfile.html"))
+    url = http_server + "/test.zip"
+    path = download(url, op.join(tempdir, "./myfile.zip"))
     assert op.exists(path)
+    path = download(url, op.join(tempdir, "./myfile2.zip"), progressbar=False)
+    with open(path, "rb") as fid, open(op.join(DATA_PATH, "test.zip"), "rb") as ref:
+        assert fid.read() == ref.read()
+
+    with ZipFile(op.join(DATA_PATH, "test.zip")) as myobj:
+        expected = myobj.read("myfile.txt")
+    for kind in ("zip", "tar", "tar.gz"):
+        url = "{}/test.{}".format(http_server, kind)
+        path = download(url, op.join(tempdir, "myfolder_" + kind), kind=kind)
+        # Path is created
+        assert op.isdir(path)
+        # File is unpacked to the right location
+        with open(op.join(path, "myfile.txt"), "rb") as fid:
+            assert fid.read() == expected
+
+
+def test_download_many(http_server):
+    """Test downloading several files at once."""
+    tempdir = _TempDir()
+    pairs = [
+        (http_server + "/test.zip", op.join(tempdir, "test.zip")),
+        (http_server + "/test.tar", op.join(tempdir, "test.tar")),
+        (http_server + "/test.tar.gz", op.join(tempdir, "folder"), {"kind": "tar.gz"}),
+    ]
+    paths = download_many(pairs, progressbar=False)
+    assert paths == [pair[1] for pair in pairs]
+    for name in ("test.zip", "test.tar"):
+        with open(op.join(tempdir, name), "rb") as fid:
+            with open(op.join(DATA_PATH, name), "rb") as ref:
+                assert fid.read() == ref.read()
+    assert op.isfile(op.join(tempdir, "folder", "myfile.txt"))
+
+    # A failed download is raised once the others are done
+    pairs.append((http_server + "/missing.zip", op.join(tempdir, "missing.zip")))
+    pairs[0] = (pairs[0][0], op.join(tempdir, "test2.zip"))
+    with pytest.raises(Exception, match="404"):
+        download_many(pairs, progressbar=False)
+    assert op.isfile(op.join(tempdir, "test2.zip"))
+
+
+def test_download_many_async(http_server):
+    """Test downloading several files from an event loop."""
+    tempdir = _TempDir()
+    pairs = [
+        (http_server + "/test.zip", op.join(tempdir, "test.zip")),
+        (http_server + "/test.tar", op.join(tempdir, "folder"), {"kind": "tar"}),
+    ]
+    paths = asyncio.run(download_many_async(pairs, progressbar=False))
+    assert paths == [pair[1] for pair in pairs]
+    with open(op.join(tempdir, "test.zip"), "rb") as fid:
+        with open(op.join(DATA_PATH, "test.zip"), "rb") as ref:
+            assert fid.read() == ref.read()
+    assert op.isfile(op.join(tempdir, "folder", "myfile.txt"))
+
+    pairs.append((http_server + "/missing.zip", op.join(tempdir, "missing.zip")))
+    with pytest.raises(Exception, match="404"):
+        asyncio.run(download_many_async(pairs, progressbar=False))
+
+
+def test_download_compressed_tar(range_server):
+    """Test unpacking bzip2 and xz compressed tar archives."""
+    tempdir = _TempDir()
+    with ZipFile(op.join(DATA_PATH, "test.zip")) as myobj:
+        expected = myobj.read("myfile.txt")
+    for kind in ("tar.bz2", "tar.xz"):
+        url = _server_url(range_server, "test." + kind)
+        path = download(url, op.join(tempdir, kind), kind=kind, verbose=False)
+        with open(op.join(path, "myfile.txt"), "rb") as fid:
+            assert fid.read() == expected
+
+
+def test_download_tar_detects_compression(http_server):
+    """Test kind="tar" also unpacks compressed tar archives."""
+    tempdir = _TempDir()
+    url = http_server + "/test.tar.gz"
+    path = download(url, op.join(tempdir, "folder"), kind="tar", verbose=False)
+    assert op.isfile(op.join(path, "myfile.txt"))
+
+
+def test_download_large_zip(http_server, monkeypatch):
+    """Test zip archives too large for memory are spooled to disk."""
+    monkeypatch.setattr(sys.modules[_fetch_file.__module__], "ZIP_SPOOL_SIZE", 1)
+    tempdir = _TempDir()
     path = download(
-        "http://google.com", op.join(tempdir, "./myfile2.html"), progressbar=False
+        http_server + "/test.zip", op.join(tempdir, "folder"), kind="zip", verbose=False
     )
-    assert op.exists(path)
+    assert op.isfile(op.join(path, "myfile.txt"))
+
 
-    # zip files
-    url_zip = "https://github.com/choldgraf/download/blob/master/download/tests/test.zip?raw=true"
-    path = download(url_zip, op.join(tempdir, "myfolder"), kind="zip")
-    # Path is created
-    assert op.isdir(path)
-    # File is zipped to the right location
-    assert op.exists(op.join(path, "myfile.txt"))
-
-    # tar files
-    url_tar = "https://github.com/choldgraf/download/blob/master/download/tests/test.tar?raw=true"
-    path = download(url_tar, op.join(tempdir, "myfolder2"), kind="tar")
-    # Path is created
-    assert op.isdir(path)
-    # File is zipped to the right location
-    assert op.exists(op.join(path, "myfile.txt"))
-
-    # tar.gz files
-    url_tar = "https://github.com/choldgraf/download/blob/master/download/tests/test.tar.gz?raw=true"
-    path = download(url_tar, op.join(tempdir, "myfolder3"), kind="tar.gz")
-    # Path is created
-    assert op.isdir(path)
-    # File is zipped to the right location
-    assert op.exists(op.join(path, "myfile.txt"))
+def test_download_removed_folder(http_server):
+    """Test downloading again into a folder that was deleted meanwhile."""
+    tempdir = _TempDir()
+    path = op.join(tempdir, "folder", "test.zip")
+    download(http_server + "/test.zip", path, verbose=False, progressbar=False)
+    shutil.rmtree(op.dirname(path))
+    download(http_server + "/test.zip", path, verbose=False, progressbar=False)
+    assert op.isfile(path)
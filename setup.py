@@ -49,6 +49,9 @@ if __name__ == "__main__":
             "Intended Audience :: Developers",
             "License :: OSI Approved",
             "Programming Language :: Python",
+            "Programming Language :: Python :: 3 :: Only",
+            "Programming Language :: Python :: 3.7",
+            "Programming Language :: Python :: 3.8",
             "Topic :: Software Development",
             "Topic :: Scientific/Engineering",
         ],
@@ -56,9 +59,11 @@ if __name__ == "__main__":
         packages=["download"],
         package_data={},
         scripts=[],
-        install_requires=["tqdm", "six", "requests"],
+        python_requires=">=3.7",
+        # download reads the http.client response wrapped by urllib3
+        install_requires=["tqdm", "six", "requests", "urllib3>=1.21.1,<3"],
         extras_require={
-            "dev": ["numpy", "codecov", "pytest", "pytest-cov"],
+            "dev": ["codecov", "pyftpdlib", "pytest", "pytest-cov"],
             "sphinx": ["matplotlib", "pandas", "sphinx", "sphinx-gallery", "pillow"],
         },
     )